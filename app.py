@@ -1,19 +1,49 @@
 import os
+
+# Tesseract's internal OpenMP parallelism would oversubscribe the cores we
+# already saturate with one OCR worker per page; must be set before the
+# tesseract library loads.
+os.environ.setdefault("OMP_THREAD_LIMIT", "1")
+
+import re
+import hashlib
+import tempfile
+import threading
 import fitz  # PyMuPDF
-import pdfplumber
 import io
-from PIL import Image
 import google.generativeai as genai
 from dotenv import load_dotenv
-import json
+import orjson
+import numpy as np
 import streamlit as st
-from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import List
+# google-generativeai converts response_schema classes through pydantic,
+# which rejects typing.TypedDict on Python < 3.12.
+from typing_extensions import TypedDict
 import pytesseract
-from fuzzywuzzy import fuzz
+from rapidfuzz import fuzz, process, utils
+
+try:
+    import tesserocr
+except ImportError:
+    # In-process libtesseract bindings are optional; without them OCR falls
+    # back to the pytesseract subprocess path.
+    tesserocr = None
+
+try:
+    import cv2
+except ImportError:
+    # OpenCV is optional; without it OCR runs on the raw grayscale pixmaps.
+    cv2 = None
 
 # --- Configuration ---
 load_dotenv()
 
+# Silence MuPDF's stderr error reporting; malformed vendor PDFs can otherwise
+# spend more time printing repair warnings than parsing.
+fitz.TOOLS.mupdf_display_errors(False)
+
 # Set Tesseract path if you are on Windows and it's not in your PATH
 # pytesseract.pytesseract.tesseract_cmd = r'C:\Program Files\Tesseract-OCR\tesseract.exe'
 
@@ -63,81 +93,458 @@ Return your findings ONLY as a single, minified JSON object. The JSON structure
 
 IMAGE_PROMPT = TEXT_PROMPT # Use the same powerful prompt for images
 
+# --- Response Schema ---
+# Mirrors the JSON structure in TEXT_PROMPT so Gemini returns valid JSON on
+# the wire instead of markdown-fenced text we have to scrub.
+class _ItemSchema(TypedDict):
+    description: str
+    quantity: float
+    price: float
+
+class _InvoiceSchema(TypedDict):
+    invoice_no: str
+    po_no: str
+    date: str
+    vendor: str
+    items: List[_ItemSchema]
+    total: float
+
+class _PoSchema(TypedDict):
+    po_no: str
+    date: str
+    vendor: str
+    items: List[_ItemSchema]
+    total: float
+
+class _AnalysisSchema(TypedDict):
+    invoice_data: _InvoiceSchema
+    po_data: _PoSchema
+
 # --- Gemini API Interaction ---
-def get_gemini_response(payload):
-    model = genai.GenerativeModel('models/gemini-pro-latest')
-    response = None
+GEMINI_MODEL_NAME = 'models/gemini-pro-latest'
+GEMINI_TEMPERATURE = 0
+
+@st.cache_resource
+def _get_model():
+    """
+    One model handle per process; constructing it sets up gRPC channels and
+    auth. The fixed TEXT_PROMPT prefix is registered as server-side cached
+    content when the API allows it, so repeat requests bill its tokens at the
+    reduced cached rate; callers then omit the prompt from their payload.
+    Returns (model, prompt_cached).
+    """
+    try:
+        prompt_cache = genai.caching.CachedContent.create(
+            model=GEMINI_MODEL_NAME, contents=[TEXT_PROMPT], ttl="3600s")
+        return genai.GenerativeModel.from_cached_content(cached_content=prompt_cache), True
+    except Exception:
+        # Context caching has a minimum token count and is not available on
+        # every model/tier; fall back to sending the prompt inline.
+        return genai.GenerativeModel(GEMINI_MODEL_NAME), False
+
+_GENERATION_CONFIG = genai.types.GenerationConfig(
+    temperature=GEMINI_TEMPERATURE,
+    response_mime_type="application/json",
+    response_schema=_AnalysisSchema,
+)
+
+def _call_gemini(payload, _retry=True):
+    model, prompt_cached = _get_model()
+    # With the prompt held in server-side cached content, only the documents
+    # travel with the request.
+    contents = payload[1:] if prompt_cached and payload and payload[0] == TEXT_PROMPT else payload
+    response_text = ""
     try:
-        generation_config = genai.types.GenerationConfig(temperature=0)
-        response = model.generate_content(payload, generation_config=generation_config)
-        json_text = response.text.strip().replace('```json', '').replace('```', '')
-        return json.loads(json_text)
+        # Stream the response so tokens accumulate as they arrive instead of
+        # blocking on the full generation.
+        chunks = []
+        for chunk in model.generate_content(contents, generation_config=_GENERATION_CONFIG, stream=True):
+            chunks.append(chunk.text)
+        response_text = "".join(chunks).strip()
+        try:
+            return orjson.loads(response_text)
+        except orjson.JSONDecodeError:
+            # Last resort if the model still wraps the payload in markdown fences.
+            return orjson.loads(response_text.removeprefix('```json').removesuffix('```'))
     except Exception as e:
+        if prompt_cached and _retry:
+            # The server-side prompt cache may have hit its TTL; rebuild the
+            # model handle (and cache entry) once and retry.
+            _get_model.clear()
+            return _call_gemini(payload, _retry=False)
         st.error(f"An error occurred with the Gemini API or its response: {e}")
-        if response:
-            st.write("Raw Gemini response:", response.text)
+        if response_text:
+            st.write("Raw Gemini response:", response_text)
+        return None
+
+def _payload_cache_key(payload):
+    """SHA256 over the payload parts plus the model name and temperature."""
+    digest = hashlib.sha256()
+    for part in payload:
+        if isinstance(part, dict) and isinstance(part.get("data"), bytes):
+            # Inline binary parts (PDF uploads) hash their raw bytes.
+            digest.update(part["data"])
+        else:
+            digest.update(str(part).encode("utf-8"))
+    digest.update(f"|{GEMINI_MODEL_NAME}|{GEMINI_TEMPERATURE}".encode("utf-8"))
+    return digest.hexdigest()
+
+class _GeminiCallFailed(Exception):
+    """Raised inside the cached call so failures are never persisted."""
+
+@st.cache_data(persist="disk", show_spinner=False)
+def _cached_gemini_call(cache_key, _payload, _policy):
+    # Only runs on a cache miss; hits are served straight from disk.
+    if _policy == "replay":
+        raise RuntimeError(f"GEMINI_CACHE=replay but no cached response for key {cache_key}")
+    result = _call_gemini(_payload)
+    if result is None:
+        # st.cache_data does not cache exceptions, so a transient API failure
+        # (quota blip, network drop) is retried on the next compare instead of
+        # being replayed from disk forever.
+        raise _GeminiCallFailed(cache_key)
+    return result
+
+def get_gemini_response(payload):
+    """
+    Calls Gemini through a persistent response cache keyed by
+    SHA256(prompt || document texts || model || temperature). The GEMINI_CACHE
+    env var selects the policy: 'enabled' (default), 'replay' (error on cache
+    miss, for reproducible runs) or 'disabled' (always call the API).
+    """
+    policy = os.environ.get("GEMINI_CACHE", "enabled").strip().lower()
+    if policy == "disabled":
+        return _call_gemini(payload)
+    try:
+        return _cached_gemini_call(_payload_cache_key(payload), payload, policy)
+    except _GeminiCallFailed:
+        # _call_gemini already surfaced the error in the UI.
+        return None
+    except RuntimeError as e:
+        st.error(str(e))
         return None
 
 # --- Helpers ---
-def get_text_from_pdf(file_path):
-    """Attempts to extract text using pdfplumber, falls back to OCR if it fails."""
+_MAX_PAGE_WORKERS = min(os.cpu_count() or 1, 4)
+
+@st.cache_resource
+def _get_ocr_pool():
+    """
+    One shared OCR pool for the whole process: when invoice and PO both need
+    OCR their pages interleave here instead of competing from two pools.
+    Cached as a resource because Streamlit re-executes the script on every
+    interaction; a module-level pool would be rebuilt each rerun, discarding
+    the warm per-thread Tesseract handles.
+    """
+    return ThreadPoolExecutor(max_workers=_MAX_PAGE_WORKERS)
+# Minimum characters a page's text layer must yield before we trust it.
+_MIN_PAGE_TEXT_CHARS = 20
+# Minimum share of alphabetic characters for a text layer to count as real
+# text rather than stray glyphs from an image-embedded page.
+_MIN_ALPHA_RATIO = 0.3
+# 200 DPI grayscale is plenty for invoice text; set OCR_DPI=300 for hard cases.
+_OCR_DPI = int(os.environ.get("OCR_DPI", "200"))
+# LSTM engine only, uniform-block page segmentation: skips Tesseract's
+# layout/engine autodetect pass, which invoices don't need.
+_TESSERACT_CONFIG = "--oem 1 --psm 6 -c preserve_interword_spaces=1"
+
+def _get_tess_api():
+    """
+    One persistent in-process Tesseract handle per OCR pool thread. The
+    handle hangs off the thread object itself (a module-level threading.local
+    would be recreated on every script rerun), so the loaded LSTM model
+    survives as long as the cached pool's threads do.
+    """
+    thread = threading.current_thread()
+    api = getattr(thread, "tess_api", None)
+    if api is None:
+        api = tesserocr.PyTessBaseAPI(psm=tesserocr.PSM.SINGLE_BLOCK,
+                                      oem=tesserocr.OEM.LSTM_ONLY)
+        thread.tess_api = api
+    return api
+
+def _binarize(pix):
+    """
+    Otsu-binarizes a grayscale pixmap so Tesseract gets clean bilevel input
+    (fewer LSTM steps spent on background noise). Returns None when OpenCV
+    is not installed.
+    """
+    if cv2 is None:
+        return None
+    arr = np.frombuffer(pix.samples, dtype=np.uint8).reshape(pix.height, pix.stride)[:, :pix.width]
+    if pix.stride != pix.width:
+        arr = np.ascontiguousarray(arr)
+    _, bw = cv2.threshold(arr, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return bw
+
+def _ocr_pixmap(pix):
+    """
+    OCRs a grayscale fitz pixmap in-process: the pixel buffer is handed to
+    libtesseract directly, so the LSTM model loads once per worker thread
+    instead of once per page.
+    """
+    api = _get_tess_api()
+    bw = _binarize(pix)
+    if bw is not None:
+        api.SetImageBytes(bw.tobytes(), pix.width, pix.height, 1, pix.width)
+    else:
+        # pix.samples is already a bytes buffer; hand it to libtesseract as-is.
+        api.SetImageBytes(pix.samples, pix.width, pix.height, pix.n, pix.stride)
+    return api.GetUTF8Text()
+
+def _ocr_page_fitz(pdf_bytes, page_num):
+    """Rasterizes a single page with fitz and OCRs it; runs in a worker thread."""
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     try:
-        text_content = ""
-        with pdfplumber.open(file_path) as pdf:
-            for page in pdf.pages:
-                page_text = page.extract_text(x_tolerance=2)
-                if page_text:
-                    text_content += page_text + "\n"
-        if text_content.strip():
-            return text_content.strip()
-    except Exception as e:
-        st.warning(f"Text extraction with pdfplumber failed: {e}. Falling back to OCR.")
-    
+        page = doc.load_page(page_num)
+        pix = page.get_pixmap(dpi=_OCR_DPI, colorspace=fitz.csGRAY)
+        return _ocr_pixmap(pix)
+    finally:
+        doc.close()
+
+def _ocr_batch_pytesseract(pdf_bytes, page_nums):
+    """
+    OCRs the given pages with a single tesseract invocation. Without
+    tesserocr, each image_to_string call would fork its own subprocess and
+    reload the model, so pages are rendered to PNGs and passed to tesseract
+    as one batch list file; the combined output is split back per page on the
+    form-feed separator tesseract emits between images.
+    """
+    doc = fitz.open(stream=pdf_bytes, filetype="pdf")
     try:
-        text_content = ""
-        doc = fitz.open(file_path)
-        for page_num in range(len(doc)):
-            page = doc.load_page(page_num)
-            pix = page.get_pixmap(dpi=300)
-            img = Image.frombytes("RGB", [pix.width, pix.height], pix.samples)
-            text_content += pytesseract.image_to_string(img) + "\n"
+        with tempfile.TemporaryDirectory() as tmpdir:
+            paths = []
+            for page_num in page_nums:
+                pix = doc.load_page(page_num).get_pixmap(dpi=_OCR_DPI, colorspace=fitz.csGRAY)
+                path = os.path.join(tmpdir, f"page-{page_num:04d}.png")
+                bw = _binarize(pix)
+                if bw is not None:
+                    cv2.imwrite(path, bw)
+                else:
+                    pix.save(path)
+                paths.append(path)
+            list_file = os.path.join(tmpdir, "pages.txt")
+            with open(list_file, "w") as f:
+                f.write("\n".join(paths))
+            text = pytesseract.image_to_string(list_file, config=_TESSERACT_CONFIG)
+    finally:
         doc.close()
-        return text_content.strip()
+    return [page_text.strip() for page_text in text.split("\f")]
+
+@st.cache_data(show_spinner=False)
+def get_text_from_pdf(pdf_bytes):
+    """
+    Extracts text from in-memory PDF bytes, deciding per page between the
+    embedded text layer and OCR. Pages whose text layer is missing, short or
+    mostly non-alphabetic (stray glyphs on image-embedded pages) are
+    rasterized and OCRed; the rest come straight from the text layer, so
+    mixed digital/scanned documents only pay for OCR where it is needed.
+    Results are cached on the content of the bytes, so re-uploading the same
+    file skips extraction entirely.
+
+    Returns (text, notices), where notices is a list of (level, message)
+    pairs for the caller to render: this function runs on worker threads,
+    where Streamlit UI calls have no ScriptRunContext and display nothing.
+    """
+    notices = []
+    try:
+        doc = fitz.open(stream=pdf_bytes, filetype="pdf")
+    except Exception as e:
+        notices.append(("error", f"Could not open PDF: {e}"))
+        return "", notices
+
+    page_count = len(doc)
+    page_texts = [""] * page_count
+    ocr_pages = list(range(page_count))
+    try:
+        for page_num in range(page_count):
+            page_text = doc[page_num].get_text("text").strip()
+            alpha_ratio = sum(c.isalpha() for c in page_text) / max(len(page_text), 1)
+            if len(page_text) >= _MIN_PAGE_TEXT_CHARS and alpha_ratio >= _MIN_ALPHA_RATIO:
+                page_texts[page_num] = page_text
+        ocr_pages = [i for i in range(page_count) if not page_texts[i]]
     except Exception as e:
-        st.error(f"OCR with Tesseract failed: {e}")
-        return ""
+        notices.append(("warning", f"Text extraction with PyMuPDF failed: {e}. Falling back to OCR."))
+    finally:
+        doc.close()
+
+    if ocr_pages:
+        try:
+            if tesserocr is not None:
+                ocr_texts = _get_ocr_pool().map(_ocr_page_fitz, [pdf_bytes] * len(ocr_pages), ocr_pages)
+            else:
+                ocr_texts = _ocr_batch_pytesseract(pdf_bytes, ocr_pages)
+            for page_num, ocr_text in zip(ocr_pages, ocr_texts):
+                page_texts[page_num] = ocr_text.strip()
+        except Exception as e:
+            notices.append(("error", f"OCR with Tesseract failed: {e}"))
+
+    return "\n".join(page_text for page_text in page_texts if page_text).strip(), notices
+
+# --- HTML Templates ---
+# Streamlit reruns the whole script on every interaction, so the card markup
+# is defined once here and only filled in per rerun.
+_ITEM_ROW_TMPL = (
+    '<tr><td class="p-2 border">{description}</td>'
+    '<td class="p-2 border">{quantity}</td>'
+    '<td class="p-2 border">${price:,.2f}</td></tr>'
+)
+
+_ITEM_TABLE_TMPL = (
+    '<table class="w-full border-collapse mt-2"><thead><tr class="table-header">'
+    '<th class="p-2 text-left border">Description</th><th class="p-2 text-left border">Quantity</th>'
+    '<th class="p-2 text-left border">Price</th></tr></thead><tbody>{rows}</tbody></table>'
+)
+
+_NO_ITEMS_HTML = '<p class="text-gray-500">No items found.</p>'
+
+# The summary card is emitted as one raw-HTML block, where markdown emphasis
+# is not parsed; this rewrites the **…** markers the summary builders use.
+_BOLD_MD_RE = re.compile(r'\*\*(.+?)\*\*')
+
+_DOC_CARD_TMPL = (
+    '<div class="card">'
+    '<h2 class="text-xl font-semibold mb-3">{title}</h2>'
+    '<p><strong>{doc_label} #:</strong> {doc_no}</p>'
+    '{po_line}'
+    '<p><strong>Date:</strong> {date}</p>'
+    '<p><strong>Vendor:</strong> {vendor}</p>'
+    '<h3 class="text-lg font-medium mt-4">Items</h3>'
+    '{items_html}'
+    '<h3 class="text-lg font-bold mt-4">Total: ${total:,.2f}</h3>'
+    '</div>'
+)
+
+# --- Item Matching Logic ---
+# Vendor names on invoice and PO rarely match verbatim (legal suffixes,
+# abbreviations); partial_ratio above this score counts as the same vendor.
+_VENDOR_SCORE_CUTOFF = 85
+
+def match_item_keys(inv_keys, po_keys, score_cutoff=85):
+    """
+    Maps each invoice item key to its best-matching PO item key.
+    Identical keys are paired directly; the rest are scored against all PO keys
+    in one vectorized rapidfuzz call so near-duplicate descriptions
+    (e.g. "Widget A" vs "Widget-A") still reconcile.
+    """
+    mapping = {}
+    po_key_set = set(po_keys)
+    unmatched = []
+    for key in inv_keys:
+        if key in po_key_set:
+            mapping[key] = key
+        else:
+            unmatched.append(key)
+    if unmatched and po_keys:
+        scores = process.cdist(unmatched, po_keys, scorer=fuzz.token_set_ratio,
+                               processor=utils.default_process,
+                               score_cutoff=score_cutoff, workers=-1)
+        for row, key in enumerate(unmatched):
+            best = int(scores[row].argmax())
+            if scores[row][best] >= score_cutoff:
+                mapping[key] = po_keys[best]
+    return mapping
 
 # --- Item Aggregation Logic ---
-def normalize_and_aggregate_items(items):
+# Strip the boilerplate "Culture " prefix (any case, any spacing) that some
+# vendors prepend, and collapse runs of whitespace, in one C-level scan each.
+_CULTURE_PREFIX_RE = re.compile(r'^\s*culture\s+', re.IGNORECASE)
+_WS_RE = re.compile(r'\s+')
+
+def _normalize_desc_key(desc):
+    """Builds the normalized comparison key for an item description."""
+    return _WS_RE.sub(' ', _CULTURE_PREFIX_RE.sub('', str(desc))).strip().lower()
+
+def _to_float(v, default=0.0):
+    """Coerces a Gemini-provided value to float, fast-pathing real numbers."""
+    if isinstance(v, (int, float)):
+        return float(v)
+    if v is None:
+        return default
+    try:
+        return float(str(v).replace(',', '.'))
+    except (ValueError, TypeError):
+        return default
+
+def get_normalized_dict(items):
     """
-    Takes a list of item dicts, aggregates quantities for identical items,
-    and returns a clean list for display.
+    Takes a list of item dicts and aggregates quantities for identical items,
+    keyed by normalized description. Computed once per analysis and shared by
+    the display tables and both summary functions.
     """
+    normalized = {}
     if not isinstance(items, list):
-        return []
-    normalized = defaultdict(lambda: {"quantity": 0, "description": "", "price": 0.0})
+        return normalized
+    # Bind the helpers to locals: LOAD_FAST beats LOAD_GLOBAL in a loop that
+    # runs once per line item.
+    norm_key = _normalize_desc_key
+    to_float = _to_float
     for item in items:
         if not isinstance(item, dict) or not item.get("description"): continue
-        desc_key = item.get("description", "").strip().lower()
-        if desc_key.startswith("culture "):
-            desc_key = desc_key[len("culture "):]
-        
-        if not normalized[desc_key]["description"]:
-            normalized[desc_key]["description"] = item.get("description")
-        try:
-            quantity = float(item.get("quantity", 0))
-            unit_price = float(str(item.get("price", 0.0)).replace(',', '.'))
-        except (ValueError, TypeError):
-            quantity, unit_price = 0, 0.0
-        normalized[desc_key]["quantity"] += quantity
-        if unit_price > 0:
-                normalized[desc_key]["price"] = unit_price
-    return list(normalized.values())
+        desc_key = norm_key(item.get("description", ""))
+
+        entry = normalized.get(desc_key)
+        if entry is None:
+            entry = {"quantity": 0, "description": item.get("description"), "price": 0.0}
+            normalized[desc_key] = entry
+        quantity = to_float(item.get("quantity", 0))
+        price = to_float(item.get("price", 0.0))
+        entry["quantity"] += quantity
+        if price > 0:
+            entry["price"] = price # Use latest price
+    return normalized
+
+def _reconcile(inv_norm, po_norm):
+    """
+    Merges the two normalized item dicts into one sorted stream of
+    (key, invoice_item, po_item) tuples where either side may be None.
+    Both summary functions drive off this stream, so they always agree on
+    pairings, and PO items missing from the invoice are surfaced instead of
+    silently dropped.
+    """
+    key_map = match_item_keys(list(inv_norm.keys()), list(po_norm.keys()))
+    matched_po_keys = set(key_map.values())
+    merged = []
+    for inv_key, inv_item in inv_norm.items():
+        po_key = key_map.get(inv_key)
+        merged.append((inv_key, inv_item, po_norm[po_key] if po_key is not None else None))
+    for po_key, po_item in po_norm.items():
+        if po_key not in matched_po_keys:
+            merged.append((po_key, None, po_item))
+    merged.sort(key=lambda t: t[0])
+    return merged
+
+# Tolerance below which invoice and PO quantities are considered equal.
+_QTY_TOLERANCE = 1e-3
+
+def _classify_quantities(reconciled):
+    """
+    Classifies each reconciled tuple's quantities as 'over', 'under' or
+    'match' in one vectorized pass. Tuples missing either side produce NaN
+    comparisons (reported as 'match' here); callers handle the None side
+    before looking at the status.
+    """
+    count = len(reconciled)
+    inv = np.fromiter((t[1]['quantity'] if t[1] else np.nan for t in reconciled),
+                      dtype=np.float64, count=count)
+    po = np.fromiter((t[2]['quantity'] if t[2] else np.nan for t in reconciled),
+                     dtype=np.float64, count=count)
+    return np.where(inv > po + _QTY_TOLERANCE, 'over',
+                    np.where(inv < po - _QTY_TOLERANCE, 'under', 'match'))
+
+def normalize_analysis(analysis):
+    """Builds the per-document normalized item dicts for one Gemini analysis."""
+    analysis = analysis or {}
+    return {
+        'invoice': get_normalized_dict(analysis.get('invoice_data', {}).get('items', [])),
+        'po': get_normalized_dict(analysis.get('po_data', {}).get('items', [])),
+    }
 
 # --- Streamlit UI ---
 st.set_page_config(page_title="Invoice & PO Matching Tool", layout="wide")
+# Only the handful of utility classes the app actually uses, inlined so the
+# page never pulls the ~3 MB Tailwind bundle from a CDN.
 st.markdown("""
-<link href="https://cdn.jsdelivr.net/npm/tailwindcss@2.2.19/dist/tailwind.min.css" rel="stylesheet">
 <style>
     .card { background-color: #ffffff; border-radius: 8px; box-shadow: 0 4px 6px rgba(0, 0, 0, 0.1); padding: 20px; margin-bottom: 20px; }
     .header { background-color: #1f2937; color: white; padding: 20px; border-radius: 8px; margin-bottom: 20px; }
@@ -146,6 +553,22 @@ st.markdown("""
     .status-approved { color: #15803d; font-weight: bold; }
     .status-review { color: #b91c1c; font-weight: bold; }
     .agent-summary { border-left: 4px solid #4f46e5; padding-left: 16px; margin-top: 16px; font-family: sans-serif; }
+    .w-full { width: 100%; }
+    .border-collapse { border-collapse: collapse; }
+    .border { border: 1px solid #e5e7eb; }
+    .p-2 { padding: 8px; }
+    .mt-2 { margin-top: 8px; }
+    .mt-3 { margin-top: 12px; }
+    .mt-4 { margin-top: 16px; }
+    .mb-3 { margin-bottom: 12px; }
+    .text-left { text-align: left; }
+    .text-sm { font-size: 0.875rem; }
+    .text-lg { font-size: 1.125rem; }
+    .text-xl { font-size: 1.25rem; }
+    .font-medium { font-weight: 500; }
+    .font-semibold { font-weight: 600; }
+    .font-bold { font-weight: 700; }
+    .text-gray-500 { color: #6b7280; }
 </style>
 """, unsafe_allow_html=True)
 
@@ -159,24 +582,40 @@ with st.sidebar:
     
     if st.button("🔍 Compare Documents", key="compare", use_container_width=True):
         if invoice_file and po_file:
-            with open(invoice_file.name, "wb") as f:
-                f.write(invoice_file.getbuffer())
-            with open(po_file.name, "wb") as f:
-                f.write(po_file.getbuffer())
-            
             with st.spinner("Analyzing documents... This may take a moment."):
-                invoice_text = get_text_from_pdf(invoice_file.name)
-                po_text = get_text_from_pdf(po_file.name)
-                
-                if invoice_text and po_text:
-                    payload = [TEXT_PROMPT, f"--- INVOICE TEXT ---\n{invoice_text}", f"--- PO TEXT ---\n{po_text}"]
-                    st.session_state['analysis'] = get_gemini_response(payload)
-                else:
-                    st.error("Failed to extract text from one or both documents.")
-                    st.session_state['analysis'] = None
-
-            os.remove(invoice_file.name)
-            os.remove(po_file.name)
+                # Gemini reads PDFs natively, so send the raw bytes and let the
+                # model do the parsing — no local text extraction or OCR.
+                payload = [
+                    TEXT_PROMPT,
+                    {"mime_type": "application/pdf", "data": invoice_file.getvalue()},
+                    {"mime_type": "application/pdf", "data": po_file.getvalue()},
+                ]
+                analysis = get_gemini_response(payload)
+
+                if analysis is None:
+                    # Multimodal upload failed (quota, document size, ...):
+                    # fall back to local extraction and send plain text.
+                    # The two documents are independent, so extract them
+                    # concurrently; fitz and Tesseract release the GIL.
+                    with ThreadPoolExecutor(max_workers=2) as pool:
+                        invoice_future = pool.submit(get_text_from_pdf, invoice_file.getvalue())
+                        po_future = pool.submit(get_text_from_pdf, po_file.getvalue())
+                        invoice_text, invoice_notices = invoice_future.result()
+                        po_text, po_notices = po_future.result()
+
+                    # Extraction problems are reported here, on the main
+                    # thread, where Streamlit can actually render them.
+                    for level, message in invoice_notices + po_notices:
+                        (st.error if level == "error" else st.warning)(message)
+
+                    if invoice_text and po_text:
+                        payload = [TEXT_PROMPT, f"--- INVOICE TEXT ---\n{invoice_text}", f"--- PO TEXT ---\n{po_text}"]
+                        analysis = get_gemini_response(payload)
+                    else:
+                        st.error("Failed to extract text from one or both documents.")
+
+                st.session_state['analysis'] = analysis
+                st.session_state['norm'] = normalize_analysis(analysis) if analysis else None
         else:
             st.error("Please upload both an Invoice and a Purchase Order file.")
     st.markdown('</div>', unsafe_allow_html=True)
@@ -185,76 +624,47 @@ if 'analysis' in st.session_state and st.session_state['analysis']:
     analysis = st.session_state['analysis']
     invoice_data = analysis.get('invoice_data', {})
     po_data = analysis.get('po_data', {})
+    norm = st.session_state.get('norm') or normalize_analysis(analysis)
 
     col1, col2 = st.columns(2)
 
-    def display_doc(title, data, doc_type):
-        st.markdown(f'<div class="card">', unsafe_allow_html=True)
-        st.markdown(f'<h2 class="text-xl font-semibold mb-3">{title}</h2>', unsafe_allow_html=True)
-        
-        doc_no_key = "invoice_no" if doc_type == "invoice" else "po_no"
-        st.markdown(f'<p><strong>{doc_type.capitalize()} #:</strong> {data.get(doc_no_key, "N/A")}</p>', unsafe_allow_html=True)
-        if doc_type == 'invoice':
-            st.markdown(f'<p><strong>PO #:</strong> {data.get("po_no", "N/A")}</p>', unsafe_allow_html=True)
-        
-        st.markdown(f'<p><strong>Date:</strong> {data.get("date", "N/A")}</p>', unsafe_allow_html=True)
-        st.markdown(f'<p><strong>Vendor:</strong> {data.get("vendor", "N/A")}</p>', unsafe_allow_html=True)
-        st.markdown('<h3 class="text-lg font-medium mt-4">Items</h3>', unsafe_allow_html=True)
-        
-        items = normalize_and_aggregate_items(data.get("items", []))
-        
+    def display_doc(title, data, doc_type, norm_items):
+        # Fill the module-level card template and emit it as one delta; every
+        # st.markdown call is a separate websocket message to the frontend.
+        items = list(norm_items.values())
         if items:
-            table_html = '<table class="w-full border-collapse mt-2"><thead><tr class="table-header">'
-            table_html += '<th class="p-2 text-left border">Description</th><th class="p-2 text-left border">Quantity</th><th class="p-2 text-left border">Price</th></tr></thead><tbody>'
-            for item in items:
-                table_html += f'<tr><td class="p-2 border">{item.get("description", "N/A")}</td>'
-                table_html += f'<td class="p-2 border">{item.get("quantity", 0)}</td>'
-                table_html += f'<td class="p-2 border">${item.get("price", 0.0):,.2f}</td></tr>'
-            table_html += '</tbody></table>'
-            st.markdown(table_html, unsafe_allow_html=True)
+            rows = "".join(
+                _ITEM_ROW_TMPL.format(
+                    description=item.get("description") or "N/A",
+                    quantity=item.get("quantity", 0),
+                    price=item.get("price", 0.0),
+                )
+                for item in items
+            )
+            items_html = _ITEM_TABLE_TMPL.format(rows=rows)
         else:
-            st.markdown('<p class="text-gray-500">No items found.</p>', unsafe_allow_html=True)
-        
-        total = data.get("total", 0.0)
-        try:
-            total_float = float(str(total).replace(',','.'))
-        except (ValueError, TypeError):
-            total_float = 0.0
-        st.markdown(f'<h3 class="text-lg font-bold mt-4">Total: ${total_float:,.2f}</h3>', unsafe_allow_html=True)
-        st.markdown('</div>', unsafe_allow_html=True)
+            items_html = _NO_ITEMS_HTML
+
+        doc_no_key = "invoice_no" if doc_type == "invoice" else "po_no"
+        po_line = f'<p><strong>PO #:</strong> {data.get("po_no", "N/A")}</p>' if doc_type == 'invoice' else ''
+        card_html = _DOC_CARD_TMPL.format(
+            title=title,
+            doc_label=doc_type.capitalize(),
+            doc_no=data.get(doc_no_key, "N/A"),
+            po_line=po_line,
+            date=data.get("date", "N/A"),
+            vendor=data.get("vendor", "N/A"),
+            items_html=items_html,
+            total=_to_float(data.get("total", 0.0)),
+        )
+        st.markdown(card_html, unsafe_allow_html=True)
 
     with col1:
-        display_doc("📄 Invoice Details", invoice_data, "invoice")
+        display_doc("📄 Invoice Details", invoice_data, "invoice", norm['invoice'])
     with col2:
-        display_doc("📑 Purchase Order Details", po_data, "po")
-
-    st.markdown('<div class="card">', unsafe_allow_html=True)
-    st.markdown('<h2 class="text-xl font-semibold">🔎 Match/Mismatch Summary</h2>', unsafe_allow_html=True)
-
-    # This helper function is now used by both summary functions
-    def get_normalized_dict(items):
-        normalized = defaultdict(lambda: {"quantity": 0, "description": "", "price": 0.0})
-        if not isinstance(items, list): return normalized
-        for item in items:
-            if not isinstance(item, dict) or not item.get("description"): continue
-            desc_key = item.get("description", "").strip().lower()
-            if desc_key.startswith("culture "):
-                desc_key = desc_key[len("culture "):]
-            
-            if not normalized[desc_key]["description"]:
-                 normalized[desc_key]["description"] = item.get("description")
-            try:
-                quantity = float(item.get("quantity", 0))
-                price = float(str(item.get("price", 0.0)).replace(',','.'))
-            except (ValueError, TypeError):
-                quantity, price = 0, 0.0
-            
-            normalized[desc_key]["quantity"] += quantity
-            if price > 0:
-                 normalized[desc_key]["price"] = price # Use latest price
-        return normalized
+        display_doc("📑 Purchase Order Details", po_data, "po", norm['po'])
 
-    def generate_match_summary(invoice_data, po_data):
+    def generate_match_summary(invoice_data, po_data, normalized_invoice_items, normalized_po_items):
         lines, issues = [], []
 
         inv_po_no_raw = invoice_data.get("po_no")
@@ -269,45 +679,42 @@ if 'analysis' in st.session_state and st.session_state['analysis']:
 
         inv_vendor_raw = invoice_data.get("vendor")
         po_vendor_raw = po_data.get("vendor")
-        inv_vendor = str(inv_vendor_raw).strip().lower().replace(' ', '') if inv_vendor_raw else ""
-        po_vendor = str(po_vendor_raw).strip().lower().replace(' ', '') if po_vendor_raw else ""
-        if inv_vendor and po_vendor and (inv_vendor in po_vendor or po_vendor in inv_vendor):
+        inv_vendor = str(inv_vendor_raw).strip() if inv_vendor_raw else ""
+        po_vendor = str(po_vendor_raw).strip() if po_vendor_raw else ""
+        if inv_vendor and po_vendor and fuzz.partial_ratio(
+                inv_vendor, po_vendor, processor=utils.default_process) > _VENDOR_SCORE_CUTOFF:
             lines.append(f"• Vendor matches: **{invoice_data.get('vendor')}** ✓")
         else:
             lines.append(f"• Vendor mismatch: Invoice ({inv_vendor_raw or 'N/A'}) vs PO ({po_vendor_raw or 'N/A'}) ✗")
             issues.append("Vendor mismatch")
 
-        invoice_total = float(str(invoice_data.get("total", 0.0)).replace(',','.'))
-        po_total = float(str(po_data.get("total", 0.0)).replace(',','.'))
+        invoice_total = _to_float(invoice_data.get("total", 0.0))
+        po_total = _to_float(po_data.get("total", 0.0))
         if abs(invoice_total - po_total) < 0.01:
             lines.append(f"• Total amount matches: **SAR {invoice_total:,.2f}** ✓")
         else:
             lines.append(f"• **Total amount mismatch**: Invoice (SAR {invoice_total:,.2f}) vs PO (SAR {po_total:,.2f}) ✗")
             issues.append("Total amount mismatch")
 
-        normalized_invoice_items = get_normalized_dict(invoice_data.get("items", []))
-        normalized_po_items = get_normalized_dict(po_data.get("items", []))
-        
-        lines.append("---")
+        lines.append("<hr>")
 
-        all_inv_keys = set(normalized_invoice_items.keys())
-        all_po_keys = set(normalized_po_items.keys())
-
-        for inv_key in all_inv_keys:
-            inv_item = normalized_invoice_items[inv_key]
+        reconciled = _reconcile(normalized_invoice_items, normalized_po_items)
+        statuses = _classify_quantities(reconciled)
+        for (key, inv_item, po_item), status in zip(reconciled, statuses):
+            if inv_item is None:
+                lines.append(f"• Item '{po_item.get('description', 'N/A')}' on the PO does not appear on the invoice. ⚠️")
+                continue
             display_desc = inv_item.get('description', 'N/A')
-            if inv_key in all_po_keys:
-                po_item = normalized_po_items[inv_key]
-                if inv_item['quantity'] > po_item['quantity'] + 0.001:
-                    lines.append(f"• **Quantity mismatch** for '{display_desc}': Invoice ({inv_item['quantity']}) **exceeds** PO quantity ({po_item['quantity']}) ✗")
-                    issues.append("Item quantity exceeds PO")
-                elif inv_item['quantity'] < po_item['quantity'] - 0.001:
-                    lines.append(f"• Quantity for '{display_desc}' is a **partial shipment**: Invoice ({inv_item['quantity']}) of PO ({po_item['quantity']}) ⚠️")
-                else:
-                    lines.append(f"• Quantity for '{display_desc}' matches. ✓")
-            else:
+            if po_item is None:
                 lines.append(f"• Item '{display_desc}' on invoice could not be found on the PO. ✗")
                 issues.append("Unmatched invoice item")
+            elif status == 'over':
+                lines.append(f"• **Quantity mismatch** for '{display_desc}': Invoice ({inv_item['quantity']}) **exceeds** PO quantity ({po_item['quantity']}) ✗")
+                issues.append("Item quantity exceeds PO")
+            elif status == 'under':
+                lines.append(f"• Quantity for '{display_desc}' is a **partial shipment**: Invoice ({inv_item['quantity']}) of PO ({po_item['quantity']}) ⚠️")
+            else:
+                lines.append(f"• Quantity for '{display_desc}' matches. ✓")
 
         if not issues:
             lines.append('<span class="status-approved">→ Status: APPROVED ✅</span>')
@@ -317,34 +724,32 @@ if 'analysis' in st.session_state and st.session_state['analysis']:
         return "<br>".join(lines)
     
     # --- START: AGENT SUMMARY FUNCTION (UPDATED) ---
-    def generate_agent_summary(invoice_data, po_data):
+    def generate_agent_summary(invoice_data, po_data, normalized_invoice_items, normalized_po_items):
         discrepancy_details = []
 
         # Check 1: Total Amount Mismatch
-        invoice_total = float(str(invoice_data.get("total", 0.0)).replace(',','.'))
-        po_total = float(str(po_data.get("total", 0.0)).replace(',','.'))
+        invoice_total = _to_float(invoice_data.get("total", 0.0))
+        po_total = _to_float(po_data.get("total", 0.0))
         if abs(invoice_total - po_total) >= 0.01:
             comparison = "higher" if invoice_total > po_total else "lower"
             discrepancy_details.append(f"The **Total Amount** on the invoice (**SAR {invoice_total:,.2f}**) is {comparison} than the Purchase Order total (**SAR {po_total:,.2f}**).")
 
         # Check 2: Line Item Mismatches
-        normalized_invoice_items = get_normalized_dict(invoice_data.get("items", []))
-        normalized_po_items = get_normalized_dict(po_data.get("items", []))
-        all_inv_keys = set(normalized_invoice_items.keys())
-        all_po_keys = set(normalized_po_items.keys())
-
-        for inv_key in all_inv_keys:
-            inv_item = normalized_invoice_items[inv_key]
+        reconciled = _reconcile(normalized_invoice_items, normalized_po_items)
+        statuses = _classify_quantities(reconciled)
+        for (key, inv_item, po_item), status in zip(reconciled, statuses):
+            if inv_item is None:
+                discrepancy_details.append(f"The item **'{po_item.get('description', 'N/A')}'** appears on the purchase order but is not billed on the invoice.")
+                continue
             display_desc = inv_item.get('description', 'N/A')
 
-            if inv_key not in all_po_keys:
+            if po_item is None:
                 discrepancy_details.append(f"The item **'{display_desc}'** appears on the invoice but was not found on the purchase order.")
                 continue
 
-            po_item = normalized_po_items[inv_key]
-            if inv_item['quantity'] > po_item['quantity'] + 0.001:
+            if status == 'over':
                 discrepancy_details.append(f"For the item **'{display_desc}'**, the invoice bills for **{inv_item['quantity']}** units, which exceeds the **{po_item['quantity']}** units listed on the purchase order.")
-            elif inv_item['quantity'] < po_item['quantity'] - 0.001:
+            elif status == 'under':
                 discrepancy_details.append(f"The invoice reflects a **partial shipment** for the item **'{display_desc}'**, with **{inv_item['quantity']}** units billed out of the **{po_item['quantity']}** total units ordered.")
         
         # Construct final summary
@@ -376,11 +781,12 @@ if 'analysis' in st.session_state and st.session_state['analysis']:
         return summary_html
     # --- END: AGENT SUMMARY FUNCTION ---
 
-    match_summary = generate_match_summary(invoice_data, po_data)
-    st.markdown(match_summary, unsafe_allow_html=True)
-    
-    st.markdown("<hr>", unsafe_allow_html=True)
-    agent_summary = generate_agent_summary(invoice_data, po_data)
-    st.markdown(agent_summary, unsafe_allow_html=True)
-
-    st.markdown('</div>', unsafe_allow_html=True)
+    summary_html = _BOLD_MD_RE.sub(r'<strong>\1</strong>', "".join([
+        '<div class="card">',
+        '<h2 class="text-xl font-semibold">🔎 Match/Mismatch Summary</h2>',
+        generate_match_summary(invoice_data, po_data, norm['invoice'], norm['po']),
+        '<hr>',
+        generate_agent_summary(invoice_data, po_data, norm['invoice'], norm['po']),
+        '</div>',
+    ]))
+    st.markdown(summary_html, unsafe_allow_html=True)